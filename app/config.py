@@ -0,0 +1,77 @@
+"""
+Per-repo settings, resolved once at startup into immutable RepoSpec records.
+"""
+import functools
+import logging
+import re
+from dataclasses import dataclass
+
+from . import git_ops
+
+logger = logging.getLogger(__name__)
+
+_RE_HTTPS = re.compile(r"https?://github\.com/([^/]+)/([^/.]+)")
+_RE_SSH = re.compile(r"github\.com:([^/]+)/([^.]+)")
+
+
+@functools.lru_cache(maxsize=256)
+def normalize_repo(repo: str) -> str:
+    """Convert 'https://github.com/owner/repo.git' -> 'owner/repo'."""
+    repo = repo.strip()
+    m = _RE_HTTPS.match(repo)
+    if m:
+        return f"{m.group(1)}/{m.group(2)}"
+    if repo.startswith("git@"):
+        m = _RE_SSH.search(repo)
+        if m:
+            return f"{m.group(1)}/{m.group(2)}"
+    return repo
+
+
+@dataclass(slots=True, frozen=True)
+class RepoSpec:
+    """One "repos" entry with defaults applied and derived strings precomputed.
+
+    owner and name are empty if repo is not in a recognizable owner/repo form.
+    """
+
+    repo: str
+    normalized: str
+    owner: str
+    name: str
+    local_path: str
+    branch: str
+    url_with_token: str
+    poll_interval: int
+    debounce: int
+
+
+def build_repo_specs(cfg: dict, token: str | None) -> list[RepoSpec]:
+    """Build a RepoSpec per entry in cfg["repos"], skipping entries without repo or local_path."""
+    poll_interval = int(cfg.get("poll_interval_seconds", 60))
+    debounce = int(cfg.get("debounce_seconds", 30))
+    specs: list[RepoSpec] = []
+    for r in cfg["repos"]:
+        repo = r.get("repo")
+        local_path = r.get("local_path")
+        if not repo or not local_path:
+            logger.warning("Skipping repo entry missing repo or local_path: %s", r)
+            continue
+        normalized = normalize_repo(repo)
+        owner, _, name = normalized.partition("/")
+        if not name:
+            owner = ""
+        specs.append(
+            RepoSpec(
+                repo=repo,
+                normalized=normalized,
+                owner=owner,
+                name=name,
+                local_path=local_path,
+                branch=r.get("branch", "main"),
+                url_with_token=git_ops.repo_url_with_token(repo, token),
+                poll_interval=int(r.get("poll_interval_seconds", poll_interval)),
+                debounce=int(r.get("debounce_seconds", debounce)),
+            )
+        )
+    return specs
@@ -1,15 +1,35 @@
 """
 Git operations: clone, pull, add, commit, push.
-Uses HTTPS with token for private repo support.
+Uses HTTPS with token for private repo support. Network operations shell out to git;
+local read-only queries go through libgit2 (pygit2) to avoid a fork per call.
 """
 import os
+import re
 import subprocess
 import logging
 
+import pygit2
+from pygit2.enums import RepositoryOpenFlag
+
 logger = logging.getLogger(__name__)
 
+# normalized local_path -> {"is_repo": True, "branch": str, "remote_url": str}; only
+# positive results are cached, so a path is re-checked until it has been cloned.
+# clone() overwrites the entry.
+_repo_cache: dict[str, dict] = {}
+
+# Leading object name of a `git ls-remote` line: "<sha>\t<ref>"
+_RE_LS_REMOTE_SHA = re.compile(r"([0-9a-f]{40}|[0-9a-f]{64})\s")
+# `git commit` messages meaning the index had nothing to commit
+_NOTHING_TO_COMMIT = ("nothing to commit", "nothing added to commit", "no changes added to commit")
+
+# Max paths per `git add` invocation in add_paths
+ADD_CHUNK_SIZE = 1000
+# Prefetch file contents before `git add` only for batches at least this large
+READAHEAD_MIN_PATHS = 16
 
-def _repo_url_with_token(repo: str, token: str | None) -> str:
+
+def repo_url_with_token(repo: str, token: str | None) -> str:
     """Build HTTPS URL with token for auth."""
     repo = repo.strip()
     if repo.startswith("https://"):
@@ -44,32 +64,121 @@ def _run_git(cwd: str, args: list[str], env: dict | None = None) -> tuple[int, s
         return -1, "", "Timeout"
 
 
-def clone(repo: str, local_path: str, token: str | None, branch: str = "main") -> bool:
-    """Clone repo into local_path. Returns True on success."""
-    url = _repo_url_with_token(repo, token)
+def _shallow_clone(url: str, local_path: str, branch: str | None) -> tuple[int, str]:
+    """Shallow single-branch clone, blobless if the server supports partial clone.
+    Returns (returncode, stderr)."""
+    args = ["clone", "--depth", "1", "--single-branch"]
+    if branch:
+        args.extend(["-b", branch])
+    code, _, err = _run_git(".", args[:1] + ["--filter=blob:none"] + args[1:] + [url, local_path])
+    if code != 0 and "filter" in err.lower():
+        # Older servers (e.g. GitHub Enterprise) may reject the filter outright
+        logger.warning("Partial clone rejected, retrying without filter: %s", err.strip())
+        code, _, err = _run_git(".", args + [url, local_path])
+    return code, err
+
+
+def clone(url: str, local_path: str, branch: str = "main") -> bool:
+    """Clone url (see repo_url_with_token) into local_path. Returns True on success.
+
+    The clone is partial (--filter=blob:none): blobs outside the checkout are not
+    downloaded, and later pulls lazily fetch the blobs they need from the promisor remote.
+    """
     os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
-    code, out, err = _run_git(".", ["clone", "--depth", "1", "-b", branch, url, local_path])
+    key = os.path.normpath(local_path)
+    _repo_cache.pop(key, None)
+    code, err = _shallow_clone(url, local_path, branch)
     if code != 0:
         # Try default branch if specified branch doesn't exist
         if "not found" in err.lower() or "couldn't find" in err.lower():
-            code2, _, _ = _run_git(".", ["clone", "--depth", "1", url, local_path])
+            code2, _ = _shallow_clone(url, local_path, None)
             if code2 == 0:
+                _repo_cache[key] = {"is_repo": True}
                 return True
         logger.error("Clone failed: %s", err)
         return False
+    _repo_cache[key] = {"is_repo": True, "branch": branch}
     return True
 
 
-def _set_remote_url(local_path: str, repo: str, token: str | None) -> None:
-    """Ensure remote origin URL uses current token."""
-    url = _repo_url_with_token(repo, token)
-    _run_git(local_path, ["remote", "set-url", "origin", url])
+def ls_remote_sha(url: str, branch: str) -> str | None:
+    """Return the remote head SHA of branch via `git ls-remote` (no REST API quota used).
+    Returns None if the ref is missing or the command fails."""
+    code, out, err = _run_git(".", ["ls-remote", "--exit-code", url, f"refs/heads/{branch}"])
+    if code == 2:
+        # --exit-code: no matching ref
+        logger.warning("ls-remote found no refs/heads/%s", branch)
+        return None
+    if code != 0:
+        logger.warning("ls-remote failed for refs/heads/%s: %s", branch, err.strip())
+        return None
+    m = _RE_LS_REMOTE_SHA.match(out)
+    return m.group(1) if m else None
+
+
+def _set_remote_url(local_path: str, url: str) -> None:
+    """Ensure remote origin URL is url (e.g. carries the current token).
+    Skips the git call if this process already set the same URL."""
+    key = os.path.normpath(local_path)
+    if _repo_cache.get(key, {}).get("remote_url") == url:
+        return
+    code, _, _ = _run_git(local_path, ["remote", "set-url", "origin", url])
+    if code == 0:
+        _repo_cache.setdefault(key, {"is_repo": True})["remote_url"] = url
+
+
+def _is_shallow(local_path: str) -> bool:
+    """Return True if local_path is a shallow clone."""
+    return os.path.isfile(os.path.join(local_path, ".git", "shallow"))
+
+
+def _ahead_count(local_path: str, branch: str) -> int | None:
+    """Number of commits on HEAD not in origin/<branch>, or None if git can't tell."""
+    code, out, _ = _run_git(local_path, ["rev-list", "--count", f"origin/{branch}..HEAD"])
+    if code != 0:
+        return None
+    try:
+        return int(out.strip())
+    except ValueError:
+        return None
+
+
+def needs_push(local_path: str, branch: str) -> bool:
+    """Return True unless HEAD is known to be contained in origin/<branch>."""
+    return _ahead_count(local_path, branch) != 0
+
+
+def _shallow_update(local_path: str, branch: str) -> bool:
+    """Move a shallow clone to the remote head with `fetch --depth=1` and
+    `reset --keep FETCH_HEAD`. --keep keeps uncommitted edits (including ones saved
+    while the fetch runs) and aborts without touching anything if an edited or untracked
+    file would be overwritten. Skipped when HEAD has unpushed commits, which the reset
+    would drop from the branch. Returns False if skipped or if the fetch or reset fails."""
+    if _ahead_count(local_path, branch) != 0:
+        return False
+    code, _, err = _run_git(local_path, ["fetch", "--depth=1", "origin", branch])
+    if code != 0:
+        logger.warning("Shallow fetch failed in %s: %s", local_path, err.strip())
+        return False
+    code, _, err = _run_git(local_path, ["reset", "--keep", "FETCH_HEAD"])
+    if code != 0:
+        logger.warning("Reset to FETCH_HEAD refused in %s: %s", local_path, err.strip())
+        return False
+    return True
+
 
+def pull(local_path: str, remote_url: str | None = None, branch: str | None = None) -> bool:
+    """Pull latest changes. Returns True on success. Pass remote_url to refresh origin first.
 
-def pull(local_path: str, token: str | None, repo: str | None = None) -> bool:
-    """Pull latest changes. Returns True on success. Pass repo to refresh remote URL with token."""
-    if repo and token:
-        _set_remote_url(local_path, repo, token)
+    Shallow clones are updated with a depth-1 fetch + `reset --keep` (see _shallow_update),
+    which keeps history from growing and avoids merges; if that is skipped or refused
+    this falls back to `git pull`. branch defaults to the checked-out branch.
+    """
+    if remote_url:
+        _set_remote_url(local_path, remote_url)
+    if _is_shallow(local_path):
+        if _shallow_update(local_path, branch or get_default_branch(local_path)):
+            return True
     code, out, err = _run_git(local_path, ["pull"])
     if code != 0:
         logger.error("Pull failed in %s: %s", local_path, err)
@@ -86,32 +195,111 @@ def add_all(local_path: str) -> bool:
     return True
 
 
+def _readahead(local_path: str, paths: list[str]) -> None:
+    """Queue kernel readahead (POSIX_FADV_WILLNEED) for every path up front, so disk reads
+    overlap with git hashing the files one by one. No-op where posix_fadvise is missing."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for p in paths:
+        try:
+            # O_NONBLOCK so a FIFO in the tree can't block the open
+            fd = os.open(os.path.join(local_path, p), os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def add_paths(local_path: str, paths: list[str]) -> bool:
+    """Stage only the given paths (relative to local_path), including deletions.
+
+    Paths are passed literally, ADD_CHUNK_SIZE per git call to stay under ARG_MAX.
+    Untracked ignored paths are skipped; git add refuses them when named explicitly.
+    """
+    repo = _open_repo(local_path)
+    if repo is None:
+        return False
+    index = repo.index
+    present: list[str] = []
+    missing: list[str] = []
+    for p in paths:
+        if os.path.lexists(os.path.join(local_path, p)):
+            if p not in index and repo.path_is_ignored(p):
+                continue
+            present.append(p)
+        else:
+            missing.append(p)
+    if len(present) >= READAHEAD_MIN_PATHS:
+        _readahead(local_path, present)
+    env = {"GIT_LITERAL_PATHSPECS": "1"}
+    for i in range(0, len(present), ADD_CHUNK_SIZE):
+        code, _, err = _run_git(local_path, ["add", "-A", "--"] + present[i:i + ADD_CHUNK_SIZE], env=env)
+        if code != 0:
+            logger.error("Git add failed: %s", err)
+            return False
+    for i in range(0, len(missing), ADD_CHUNK_SIZE):
+        code, _, err = _run_git(
+            local_path,
+            ["rm", "-r", "-q", "--cached", "--ignore-unmatch", "--"] + missing[i:i + ADD_CHUNK_SIZE],
+            env=env,
+        )
+        if code != 0:
+            logger.error("Git rm --cached failed: %s", err)
+            return False
+    return True
+
+
+def has_staged_changes(local_path: str) -> bool:
+    """Return True if the index differs from HEAD (or git cannot tell, e.g. no HEAD yet)."""
+    code, _, _ = _run_git(local_path, ["diff", "--cached", "--quiet"])
+    return code != 0
+
+
+def _open_repo(local_path: str) -> pygit2.Repository | None:
+    """Open the repository at exactly local_path (no upward search), or None."""
+    try:
+        return pygit2.Repository(local_path, RepositoryOpenFlag.NO_SEARCH)
+    except pygit2.GitError:
+        return None
+
+
 def has_changes(local_path: str) -> bool:
-    """Return True if there are staged or unstaged changes."""
-    code, out, _ = _run_git(local_path, ["status", "--porcelain"])
-    return code == 0 and bool(out.strip())
+    """Return True if there are staged, unstaged or untracked changes."""
+    repo = _open_repo(local_path)
+    if repo is None:
+        return False
+    try:
+        return bool(repo.status(untracked_files="normal"))
+    except pygit2.GitError as e:
+        logger.error("Status failed in %s: %s", local_path, e)
+        return False
 
 
 def commit(local_path: str, message: str, user_name: str, user_email: str) -> bool:
-    """Create commit with configured user."""
+    """Create commit with configured user. An empty index counts as success (no commit)."""
     env = {"GIT_AUTHOR_NAME": user_name, "GIT_AUTHOR_EMAIL": user_email}
-    code, _, err = _run_git(
+    code, out, err = _run_git(
         local_path,
         ["commit", "-m", message],
         env=env,
     )
     if code != 0:
-        if "nothing to commit" in err:
+        # git reports an empty index on stdout
+        if any(msg in out or msg in err for msg in _NOTHING_TO_COMMIT):
             return True
         logger.error("Commit failed: %s", err)
         return False
     return True
 
 
-def push(local_path: str, token: str | None, branch: str | None = None, repo: str | None = None) -> bool:
-    """Push to remote. Pass repo to refresh remote URL with token."""
-    if repo and token:
-        _set_remote_url(local_path, repo, token)
+def push(local_path: str, branch: str | None = None, remote_url: str | None = None) -> bool:
+    """Push to remote. Pass remote_url to refresh origin first."""
+    if remote_url:
+        _set_remote_url(local_path, remote_url)
     args = ["push"]
     if branch:
         args.extend(["origin", branch])
@@ -123,23 +311,38 @@ def push(local_path: str, token: str | None, branch: str | None = None, repo: st
 
 
 def is_git_repo(path: str) -> bool:
-    """Return True if path is a git repository."""
-    git_dir = os.path.join(path, ".git")
-    return os.path.isdir(git_dir)
+    """Return True if path is a git repository. Positive results are cached."""
+    key = os.path.normpath(path)
+    if key in _repo_cache:
+        return True
+    if not os.path.isfile(os.path.join(key, ".git", "HEAD")):
+        return False
+    _repo_cache[key] = {"is_repo": True}
+    return True
 
 
 def get_default_branch(local_path: str) -> str:
-    """Get default branch (e.g. main or master)."""
-    code, out, _ = _run_git(local_path, ["rev-parse", "--abbrev-ref", "HEAD"])
-    if code == 0 and out.strip():
-        return out.strip()
-    return "main"
+    """Get default branch (e.g. main or master). Cached per path until the next clone."""
+    key = os.path.normpath(local_path)
+    cached = _repo_cache.get(key)
+    if cached and "branch" in cached:
+        return cached["branch"]
+    repo = _open_repo(local_path)
+    if repo is None:
+        return "main"
+    try:
+        branch = repo.head.shorthand or "main"
+    except pygit2.GitError:
+        # Unborn HEAD (no commits yet); don't cache, the first commit will set it
+        return "main"
+    _repo_cache.setdefault(key, {"is_repo": True})["branch"] = branch
+    return branch
 
 
-def pull_before_push(local_path: str, repo: str | None = None, token: str | None = None) -> bool:
+def pull_before_push(local_path: str, remote_url: str | None = None) -> bool:
     """Pull with rebase to integrate remote changes before push."""
-    if repo and token:
-        _set_remote_url(local_path, repo, token)
+    if remote_url:
+        _set_remote_url(local_path, remote_url)
     code, _, err = _run_git(local_path, ["pull", "--rebase"])
     if code != 0:
         logger.error("Pull --rebase failed: %s", err)
@@ -1,92 +1,353 @@
 """
 Polls GitHub API for new commits and pulls to local directory.
 """
+import asyncio
 import logging
-import re
 import threading
 import time
-from typing import Callable
+from typing import Awaitable, Callable, Mapping
 
-import requests
+import aiohttp
 
 from . import git_ops
+from .config import RepoSpec
 
 logger = logging.getLogger(__name__)
 
 GITHUB_API = "https://api.github.com"
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+# Retry transient failures: connection errors, timeouts and these gateway statuses
+RETRY_TOTAL = 3
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_STATUSES = (502, 503, 504)
+# Commit endpoint media type that returns just the SHA as plain text
+SHA_MEDIA_TYPE = "application/vnd.github.sha"
 
+POLL_MODES = ("polling", "webhook", "auto")
+# Max repositories per GraphQL query (aliases r0..rN)
+GRAPHQL_BATCH_SIZE = 50
+# In "auto" mode, poll this often as a fallback for missed webhook deliveries
+WEBHOOK_FALLBACK_SECONDS = 300
 
-def _normalize_repo(repo: str) -> str:
-    """Convert 'https://github.com/owner/repo.git' -> 'owner/repo'."""
-    repo = repo.strip()
-    m = re.match(r"https?://github\.com/([^/]+)/([^/.]+)", repo)
-    if m:
-        return f"{m.group(1)}/{m.group(2)}"
-    if repo.startswith("git@"):
-        m = re.search(r"github\.com:([^/]+)/([^.]+)", repo)
-        if m:
-            return f"{m.group(1)}/{m.group(2)}"
-    return repo
+# Below this many remaining API calls, spread polls evenly until the quota resets
+RATE_LIMIT_LOW_WATER = 100
 
+# (owner, repo, branch) -> (etag, sha) from the last successful 200 response
+_etag_cache: dict[tuple[str, str, str], tuple[str, str]] = {}
 
-def fetch_latest_sha(owner: str, repo_name: str, branch: str, token: str | None) -> str | None:
-    """Fetch latest commit SHA for branch from GitHub API. Returns None on failure."""
+
+def create_session() -> aiohttp.ClientSession:
+    """Build the shared GitHub API session: pooled keep-alive connections, default
+    Accept header and timeout. Must be called from within the running event loop."""
+    connector = aiohttp.TCPConnector(limit=16, limit_per_host=8, keepalive_timeout=120)
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={"Accept": "application/vnd.github+json"},
+        timeout=REQUEST_TIMEOUT,
+    )
+
+
+async def _send(
+    session: aiohttp.ClientSession, method: str, url: str, **kwargs
+) -> aiohttp.ClientResponse:
+    """Send a request, retrying transient failures with exponential backoff.
+    Use as `async with await _send(...) as r:` so the connection is released."""
+    attempt = 0
+    while True:
+        try:
+            r = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt >= RETRY_TOTAL:
+                raise
+        else:
+            if attempt >= RETRY_TOTAL or r.status not in RETRY_STATUSES:
+                return r
+            r.release()
+        await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+        attempt += 1
+
+
+async def _read_sha(
+    r: aiohttp.ClientResponse, key: tuple[str, str, str], cached: tuple[str, str] | None, raw: bool
+) -> tuple[str | None, Mapping[str, str]]:
+    if r.status == 304 and cached:
+        return cached[1], r.headers
+    r.raise_for_status()
+    if raw:
+        sha = (await r.text()).strip() or None
+    else:
+        sha = (await r.json()).get("sha")
+    etag = r.headers.get("ETag")
+    if sha and etag:
+        _etag_cache[key] = (etag, sha)
+    return sha, r.headers
+
+
+async def fetch_latest_sha(
+    session: aiohttp.ClientSession, owner: str, repo_name: str, branch: str, token: str | None
+) -> tuple[str | None, Mapping[str, str]]:
+    """Fetch latest commit SHA for branch from GitHub API.
+
+    Returns (sha, response headers); sha is None on failure. Asks for the bare SHA
+    (Accept: application/vnd.github.sha) rather than the full commit JSON, falling back
+    to JSON on 415. Sends If-None-Match with the cached ETag; a 304 reply costs no rate
+    limit and returns the cached SHA.
+    """
     url = f"{GITHUB_API}/repos/{owner}/{repo_name}/commits/{branch}"
-    headers = {"Accept": "application/vnd.github.v3+json"}
+    headers = {"Accept": SHA_MEDIA_TYPE}
     if token:
         headers["Authorization"] = f"Bearer {token}"
+    key = (owner, repo_name, branch)
+    cached = _etag_cache.get(key)
+    if cached:
+        headers["If-None-Match"] = cached[0]
     try:
-        r = requests.get(url, headers=headers, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        return data.get("sha")
-    except requests.RequestException as e:
+        async with await _send(session, "GET", url, headers=headers) as r:
+            if r.status != 415:
+                return await _read_sha(r, key, cached, raw=True)
+        headers["Accept"] = "application/vnd.github+json"
+        async with await _send(session, "GET", url, headers=headers) as r:
+            return await _read_sha(r, key, cached, raw=False)
+    except aiohttp.ClientResponseError as e:
         logger.warning("Failed to fetch commit SHA for %s/%s: %s", owner, repo_name, e)
+        return None, e.headers or {}
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning("Failed to fetch commit SHA for %s/%s: %s", owner, repo_name, e)
+        return None, {}
+
+
+def _next_wait(interval_seconds: int, headers: Mapping[str, str]) -> float:
+    """Seconds until the next poll, honoring X-Poll-Interval and the remaining rate limit."""
+    wait = float(interval_seconds)
+    try:
+        wait = max(wait, int(headers.get("X-Poll-Interval", 0)))
+    except ValueError:
+        pass
+    try:
+        remaining = int(headers["X-RateLimit-Remaining"])
+        reset = int(headers["X-RateLimit-Reset"])
+    except (KeyError, ValueError):
+        return wait
+    if remaining < RATE_LIMIT_LOW_WATER:
+        until_reset = max(0.0, reset - time.time())
+        wait = max(wait, until_reset / max(remaining, 1))
+    return wait
+
+
+def _rate_limit_reset(headers: Mapping[str, str]) -> float | None:
+    """If headers show the REST quota is exhausted, return the reset epoch time."""
+    if headers.get("X-RateLimit-Remaining") != "0":
         return None
+    try:
+        return float(headers["X-RateLimit-Reset"])
+    except (KeyError, ValueError):
+        return time.time() + 60
+
+
+def _idle_wait(mode: str, next_wait: float) -> float | None:
+    """How long to sleep between successful polls for the given mode."""
+    if mode == "webhook":
+        return None
+    if mode == "auto":
+        return max(next_wait, WEBHOOK_FALLBACK_SECONDS)
+    return next_wait
+
+
+def _locked(lock: threading.Lock, fn: Callable[..., bool], *args) -> bool:
+    """Run fn(*args) while holding lock; for use with asyncio.to_thread."""
+    with lock:
+        return fn(*args)
+
 
+async def _sync_to_sha(
+    spec: RepoSpec,
+    lock: threading.Lock,
+    sha: str,
+    last_sha: str | None,
+    on_pull: Callable[[], None] | None,
+) -> str | None:
+    """Clone or pull spec.local_path if sha is new, holding the repo's lock so it never
+    races the watcher's commit+push. Returns the SHA now considered synced."""
+    if not git_ops.is_git_repo(spec.local_path):
+        logger.info("Cloning %s into %s", spec.repo, spec.local_path)
+        if await asyncio.to_thread(
+            _locked, lock, git_ops.clone, spec.url_with_token, spec.local_path, spec.branch
+        ):
+            if on_pull:
+                on_pull()
+            return sha
+        logger.error("Clone failed for %s", spec.repo)
+        return last_sha
+    if last_sha is not None and sha != last_sha:
+        logger.info("New commit on %s, pulling", spec.repo)
+        if await asyncio.to_thread(
+            _locked, lock, git_ops.pull, spec.local_path, spec.url_with_token, spec.branch
+        ):
+            if on_pull:
+                on_pull()
+            return sha
+        return last_sha
+    return last_sha if last_sha is not None else sha
 
-def poll_loop(
-    repo: str,
-    local_path: str,
+
+def make_poll_job(
+    session: aiohttp.ClientSession,
+    spec: RepoSpec,
+    lock: threading.Lock,
     token: str | None,
-    branch: str,
-    interval_seconds: int,
-    stop_event: threading.Event,
+    mode: str = "polling",
     on_pull: Callable[[], None] | None = None,
-) -> None:
-    """Run polling loop: check GitHub for new commit, clone or pull as needed."""
-    normalized = _normalize_repo(repo)
-    if "/" not in normalized:
-        logger.error("Invalid repo format: %s", repo)
-        return
-    owner, repo_name = normalized.split("/", 1)
+) -> Callable[[], Awaitable[float | None]] | None:
+    """Build a PollScheduler job that checks GitHub for a new commit and clones or pulls.
+
+    The job returns the delay until its next run. mode is one of POLL_MODES: "polling"
+    checks every interval, "webhook" only at startup and when woken, "auto" also every
+    WEBHOOK_FALLBACK_SECONDS in case a delivery is missed. Returns None for a bad repo.
+    """
+    if not spec.owner:
+        logger.error("Invalid repo format: %s", spec.repo)
+        return None
     last_sha: str | None = None
+    # While the REST quota is exhausted, poll with `git ls-remote` until this epoch time
+    rate_limited_until = 0.0
 
-    while not stop_event.is_set():
+    async def poll() -> float | None:
+        nonlocal last_sha, rate_limited_until
+        next_wait: float = spec.poll_interval
         try:
-            sha = fetch_latest_sha(owner, repo_name, branch, token)
-            if sha is None:
-                time.sleep(interval_seconds)
-                continue
-
-            if not git_ops.is_git_repo(local_path):
-                logger.info("Cloning %s into %s", repo, local_path)
-                if git_ops.clone(repo, local_path, token, branch):
-                    last_sha = sha
-                    if on_pull:
-                        on_pull()
-                else:
-                    logger.error("Clone failed for %s", repo)
-            elif last_sha is not None and sha != last_sha:
-                logger.info("New commit on %s, pulling", repo)
-                if git_ops.pull(local_path, token, repo):
-                    last_sha = sha
-                    if on_pull:
-                        on_pull()
+            if time.time() < rate_limited_until:
+                sha = await asyncio.to_thread(git_ops.ls_remote_sha, spec.url_with_token, spec.branch)
             else:
-                if last_sha is None:
-                    last_sha = sha
+                sha, headers = await fetch_latest_sha(
+                    session, spec.owner, spec.name, spec.branch, token
+                )
+                next_wait = _next_wait(spec.poll_interval, headers)
+                reset = _rate_limit_reset(headers) if sha is None else None
+                if reset is not None:
+                    logger.warning(
+                        "GitHub API rate limit exhausted; using git ls-remote for %s", spec.repo
+                    )
+                    rate_limited_until = reset
+                    next_wait = spec.poll_interval
+                    sha = await asyncio.to_thread(
+                        git_ops.ls_remote_sha, spec.url_with_token, spec.branch
+                    )
+            if sha is None:
+                return next_wait
+            last_sha = await _sync_to_sha(spec, lock, sha, last_sha, on_pull)
         except Exception as e:
-            logger.exception("Poll error for %s: %s", repo, e)
+            logger.exception("Poll error for %s: %s", spec.repo, e)
+        return _idle_wait(mode, next_wait)
+
+    return poll
+
+
+async def fetch_latest_shas_batched(
+    session: aiohttp.ClientSession,
+    repos: list[tuple[str, str, str]],
+    token: str,
+) -> tuple[dict[tuple[str, str, str], str], Mapping[str, str]]:
+    """Fetch head SHAs for many (owner, name, branch) refs with one GraphQL query per
+    GRAPHQL_BATCH_SIZE repos. Returns ({ref: sha} for refs found, last response headers).
+    """
+    shas: dict[tuple[str, str, str], str] = {}
+    resp_headers: Mapping[str, str] = {}
+    headers = {"Authorization": f"Bearer {token}"}
+    for start in range(0, len(repos), GRAPHQL_BATCH_SIZE):
+        chunk = repos[start:start + GRAPHQL_BATCH_SIZE]
+        params = []
+        fields = []
+        variables: dict[str, str] = {}
+        for i, (owner, name, branch) in enumerate(chunk):
+            params.append(f"$o{i}: String!, $n{i}: String!, $q{i}: String!")
+            fields.append(
+                f"r{i}: repository(owner: $o{i}, name: $n{i}) "
+                f"{{ ref(qualifiedName: $q{i}) {{ target {{ oid }} }} }}"
+            )
+            variables.update({f"o{i}": owner, f"n{i}": name, f"q{i}": f"refs/heads/{branch}"})
+        query = f"query({', '.join(params)}) {{ {' '.join(fields)} }}"
+        try:
+            async with await _send(
+                session,
+                "POST",
+                f"{GITHUB_API}/graphql",
+                json={"query": query, "variables": variables},
+                headers=headers,
+            ) as r:
+                resp_headers = r.headers
+                r.raise_for_status()
+                body = await r.json()
+        except aiohttp.ClientResponseError as e:
+            logger.warning("Batched GraphQL SHA lookup failed: %s", e)
+            return shas, e.headers or {}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Batched GraphQL SHA lookup failed: %s", e)
+            return shas, resp_headers
+        for err in body.get("errors") or []:
+            logger.warning("GraphQL error: %s", err.get("message"))
+        data = body.get("data") or {}
+        for i, target in enumerate(chunk):
+            ref = (data.get(f"r{i}") or {}).get("ref") or {}
+            oid = (ref.get("target") or {}).get("oid")
+            if oid:
+                shas[target] = oid
+    return shas, resp_headers
+
 
-        stop_event.wait(interval_seconds)
+def make_batch_poll_job(
+    session: aiohttp.ClientSession,
+    queues: dict[tuple[str, str, str], list[asyncio.Queue]],
+    token: str,
+    interval_seconds: int,
+    mode: str = "polling",
+) -> Callable[[], Awaitable[float | None]]:
+    """Build a PollScheduler job that polls every (owner, name, branch) in queues with one
+    batched query and puts each SHA on that ref's queues for sync_worker. mode behaves as
+    in make_poll_job.
+    """
+    refs = list(queues)
+
+    async def poll() -> float | None:
+        next_wait: float = interval_seconds
+        try:
+            shas, headers = await fetch_latest_shas_batched(session, refs, token)
+            next_wait = _next_wait(interval_seconds, headers)
+            if not shas:
+                return next_wait
+            for ref, sha in shas.items():
+                for q in queues[ref]:
+                    q.put_nowait(sha)
+        except Exception as e:
+            logger.exception("Batched poll error: %s", e)
+        return _idle_wait(mode, next_wait)
+
+    return poll
+
+
+async def sync_worker(
+    spec: RepoSpec,
+    lock: threading.Lock,
+    queue: asyncio.Queue,
+    stop_event: asyncio.Event,
+    on_pull: Callable[[], None] | None = None,
+) -> None:
+    """Clone or pull spec.local_path for each SHA the batch poll job puts on queue."""
+    last_sha: str | None = None
+    stop_wait = asyncio.ensure_future(stop_event.wait())
+    try:
+        while not stop_event.is_set():
+            get = asyncio.ensure_future(queue.get())
+            await asyncio.wait([get, stop_wait], return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                break
+            sha = get.result()
+            # Only the newest queued SHA matters
+            while not queue.empty():
+                sha = queue.get_nowait()
+            try:
+                last_sha = await _sync_to_sha(spec, lock, sha, last_sha, on_pull)
+            except Exception as e:
+                logger.exception("Sync error for %s: %s", spec.repo, e)
+    finally:
+        stop_wait.cancel()
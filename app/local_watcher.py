@@ -2,6 +2,7 @@
 Watches local directories for file changes; debounces and commits + pushes.
 """
 import logging
+import os
 import threading
 import time
 from pathlib import Path
@@ -10,77 +11,201 @@ import watchdog.events
 import watchdog.observers
 
 from . import git_ops
+from .config import RepoSpec
 
 logger = logging.getLogger(__name__)
 
+# Only subscribe to the events the handler reacts to. On Linux this narrows the inotify
+# mask, so the kernel never reports the IN_OPEN / IN_CLOSE_NOWRITE storm from git reads.
+WATCHED_EVENTS = [
+    watchdog.events.FileModifiedEvent,
+    watchdog.events.FileCreatedEvent,
+    watchdog.events.DirCreatedEvent,
+    watchdog.events.FileDeletedEvent,
+    watchdog.events.DirDeletedEvent,
+    watchdog.events.FileMovedEvent,
+    watchdog.events.DirMovedEvent,
+]
+
+# Past this many distinct changed paths, stop tracking them and stage with `git add -A`
+MAX_TRACKED_PATHS = 10_000
+
+# A failed commit+push is retried after debounce * 2**n seconds (n = failures in a row),
+# at most this long; a new file event instead retries after the normal debounce
+MAX_RETRY_SECONDS = 3600
+
+_GIT_DIR_INFIX = f"{os.sep}.git{os.sep}"
+_GIT_DIR_SUFFIX = f"{os.sep}.git"
+
+
+def _is_git_path(path: str) -> bool:
+    """Return True if path is a .git directory or inside one."""
+    return _GIT_DIR_INFIX in path or path.endswith(_GIT_DIR_SUFFIX)
+
 
 class DebouncedCommitHandler(watchdog.events.FileSystemEventHandler):
-    """On file event, reset debounce timer; when timer fires, commit and push."""
+    """On file event, record the time; once no event has arrived for the debounce
+    period, a single long-lived worker thread commits and pushes."""
 
     def __init__(
         self,
-        local_path: str,
-        debounce_seconds: int,
+        spec: RepoSpec,
+        lock: threading.Lock,
         user_name: str,
         user_email: str,
-        token: str | None,
-        repo: str | None,
-        branch: str | None,
         pull_before_push: bool,
     ):
         super().__init__()
-        self.local_path = local_path
-        self.debounce_seconds = debounce_seconds
+        self.spec = spec
+        # Shared with the poller so only one git operation runs on local_path at a time
+        self.lock = lock
+        self.local_path = str(Path(spec.local_path))
+        self.debounce_seconds = spec.debounce
         self.user_name = user_name
         self.user_email = user_email
-        self.token = token
-        self.repo = repo
-        self.branch = branch
         self.pull_before_push = pull_before_push
-        self._timer: threading.Timer | None = None
-        self._lock = threading.Lock()
-
-    def _reset_timer(self) -> None:
-        with self._lock:
-            if self._timer:
-                self._timer.cancel()
-            self._timer = threading.Timer(self.debounce_seconds, self._on_timer)
-            self._timer.daemon = True
-            self._timer.start()
-
-    def _on_timer(self) -> None:
-        with self._lock:
-            self._timer = None
-        self._do_commit_and_push(self.local_path)
+        self._cond = threading.Condition()
+        self._last_event = 0.0
+        # Set by file events (and by failed cycles, to retry); cleared when a cycle starts
+        self._pending = False
+        # Backoff state for retrying failed cycles; _retry_at is 0 when no retry is due
+        self._failures = 0
+        self._retry_at = 0.0
+        # Paths (relative to local_path) changed since the last commit; when _full_add is
+        # set they are not tracked and the whole tree is staged. The first commit after
+        # startup is a full add to pick up edits made while nothing was watching.
+        self._changed: set[str] = set()
+        self._full_add = True
+        self._stopped = False
+        self._worker = threading.Thread(target=self._debounce_worker, daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        """Stop the debounce worker; pending changes are left for the next run."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _debounce_worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                due = max(self._last_event + self.debounce_seconds, self._retry_at)
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._pending = False
+                self._retry_at = 0.0
+            try:
+                self._do_commit_and_push(self.local_path)
+            except Exception:
+                logger.exception("Commit and push failed in %s", self.local_path)
+                with self._cond:
+                    # The changed-path set was already taken; restage everything
+                    self._full_add = True
+                    self._changed.clear()
+                    self._retry_later()
+
+    def _retry_later(self) -> None:
+        """Schedule another cycle after an exponential backoff. Caller holds self._cond."""
+        delay = min(max(self.debounce_seconds, 1) * 2 ** self._failures, MAX_RETRY_SECONDS)
+        self._failures = min(self._failures + 1, 16)
+        if self._pending:
+            # An edit during the failed cycle already queued the next one
+            return
+        self._retry_at = time.monotonic() + delay
+        self._pending = True
+        logger.warning("Retrying commit and push in %s in %ds", self.local_path, delay)
 
     def _do_commit_and_push(self, local_path: str) -> None:
-        if not git_ops.is_git_repo(local_path):
+        with self._cond:
+            changed, self._changed = self._changed, set()
+            full_add, self._full_add = self._full_add, False
+        if self._commit_and_push(local_path, None if full_add else sorted(changed)):
+            with self._cond:
+                self._failures = 0
             return
+        with self._cond:
+            self._full_add = self._full_add or full_add
+            if not self._full_add:
+                self._changed |= changed
+            self._retry_later()
+
+    def _commit_and_push(self, local_path: str, paths: list[str] | None) -> bool:
+        """Commit and push any changes, staging only paths unless it is None.
+        Returns False if a step failed."""
+        with self.lock:
+            return self._commit_and_push_locked(local_path, paths)
+
+    def _commit_and_push_locked(self, local_path: str, paths: list[str] | None) -> bool:
+        if not git_ops.is_git_repo(local_path):
+            # Not cloned (yet): nothing to commit, and retrying would not help
+            return True
         if not git_ops.has_changes(local_path):
-            return
+            return True
         logger.info("Committing and pushing changes in %s", local_path)
         if self.pull_before_push:
-            if not git_ops.pull_before_push(local_path, self.repo, self.token):
+            if not git_ops.pull_before_push(local_path, self.spec.url_with_token):
                 logger.warning("Pull before push failed, skipping push")
-                return
-        if not git_ops.add_all(local_path):
-            return
+                return False
+        # Fall back to staging the whole tree if targeted staging fails or stages nothing,
+        # i.e. has_changes saw a change the events missed (inotify overflow, watch limit)
+        staged = (
+            paths is not None
+            and git_ops.add_paths(local_path, paths)
+            and git_ops.has_staged_changes(local_path)
+        )
+        if not staged and not git_ops.add_all(local_path):
+            return False
         if not git_ops.commit(
             local_path,
             "GitSync: auto sync",
             self.user_name,
             self.user_email,
         ):
-            return
-        if not git_ops.push(local_path, self.token, self.branch, self.repo):
+            return False
+        # Nothing new to send, e.g. staging turned out empty and commit was a no-op
+        if not git_ops.needs_push(local_path, self.spec.branch):
+            return True
+        if not git_ops.push(local_path, self.spec.branch, self.spec.url_with_token):
             logger.error("Push failed for %s", local_path)
+            return False
+        return True
 
-    def _on_event(self, event: watchdog.events.FileSystemEvent) -> None:
-        # Ignore .git directory changes
-        src = str(event.src_path) if event.src_path else ""
-        if ".git" in Path(src).parts:
+    def dispatch(self, event: watchdog.events.FileSystemEvent) -> None:
+        # Drop .git churn before watchdog resolves the on_* handler
+        if event.src_path and _is_git_path(os.fsdecode(event.src_path)):
             return
-        self._reset_timer()
+        super().dispatch(event)
+
+    def _record(self, path: bytes | str) -> None:
+        """Add path to the changed set. Caller holds self._cond."""
+        if self._full_add:
+            return
+        rel = os.path.relpath(os.fsdecode(path), self.local_path)
+        if rel.startswith(os.pardir) or len(self._changed) >= MAX_TRACKED_PATHS:
+            self._full_add = True
+            self._changed.clear()
+            return
+        self._changed.add(rel)
+
+    def _on_event(self, event: watchdog.events.FileSystemEvent) -> None:
+        with self._cond:
+            self._last_event = time.monotonic()
+            self._record(event.src_path)
+            if event.dest_path:
+                self._record(event.dest_path)
+            if not self._pending:
+                self._pending = True
+                self._cond.notify()
+            elif self._retry_at:
+                # New edits retry after the normal debounce, not the backoff delay
+                self._retry_at = 0.0
+                self._cond.notify()
 
     def on_modified(self, event: watchdog.events.FileSystemEvent) -> None:
         if event.is_directory:
@@ -98,39 +223,34 @@ class DebouncedCommitHandler(watchdog.events.FileSystemEventHandler):
 
 
 def watch_loop(
-    local_path: str,
-    debounce_seconds: int,
+    spec: RepoSpec,
+    lock: threading.Lock,
     user_name: str,
     user_email: str,
-    token: str | None,
-    repo: str | None,
-    branch: str | None,
     pull_before_push: bool,
     stop_event: threading.Event,
 ) -> None:
-    """Start watchdog observer on local_path with debounced commit+push."""
-    path = Path(local_path)
+    """Start watchdog observer on spec.local_path with debounced commit+push."""
+    path = Path(spec.local_path)
     while not path.exists() and not stop_event.is_set():
         stop_event.wait(5)
     if not path.exists():
         return
     handler = DebouncedCommitHandler(
-        local_path=str(path),
-        debounce_seconds=debounce_seconds,
+        spec=spec,
+        lock=lock,
         user_name=user_name,
         user_email=user_email,
-        token=token,
-        repo=repo,
-        branch=branch,
         pull_before_push=pull_before_push,
     )
     observer = watchdog.observers.Observer()
-    observer.schedule(handler, str(path), recursive=True)
+    observer.schedule(handler, str(path), recursive=True, event_filter=WATCHED_EVENTS)
     observer.start()
-    logger.info("Watching %s (debounce=%ds)", local_path, debounce_seconds)
+    logger.info("Watching %s (debounce=%ds)", spec.local_path, spec.debounce)
     try:
         while not stop_event.is_set():
             stop_event.wait(1.0)
     finally:
         observer.stop()
         observer.join(timeout=5.0)
+        handler.stop()
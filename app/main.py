@@ -1,6 +1,9 @@
 """
 GitSync: Monitors GitHub for new commits (pulls) and local dirs for changes (debounced commit+push).
 """
+import asyncio
+import concurrent.futures
+import functools
 import json
 import logging
 import os
@@ -8,9 +11,14 @@ import signal
 import sys
 import threading
 from pathlib import Path
+from typing import Callable
 
+from . import git_ops
 from . import github_poller
 from . import local_watcher
+from . import webhook_server
+from .config import RepoSpec, build_repo_specs
+from .scheduler import PollScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -33,70 +41,164 @@ def load_config(path: str) -> dict:
     return cfg
 
 
-def main() -> None:
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    )
-    config_path = os.environ.get("CONFIG_PATH", "/config/config.json")
-    token = os.environ.get("GITHUB_TOKEN")  # Override config if set
-    cfg = load_config(config_path)
-    if token:
-        cfg["github_token"] = token
-    poll_interval = int(cfg.get("poll_interval_seconds", 60))
-    debounce = int(cfg.get("debounce_seconds", 30))
+async def clone_missing(specs: list[RepoSpec]) -> None:
+    """Clone every spec whose local_path is not yet a repository, in parallel.
+
+    Uses a bounded pool of max(3, 3/4 of CPUs) workers; returns once all clones finish.
+    Failed clones are retried later by the poll loop.
+    """
+    missing: dict[str, RepoSpec] = {}
+    for spec in specs:
+        if spec.local_path not in missing and not git_ops.is_git_repo(spec.local_path):
+            missing[spec.local_path] = spec
+    if not missing:
+        return
+    workers = min(len(missing), max(3, (os.cpu_count() or 1) * 3 // 4))
+    logger.info("Cloning %d repo(s) with %d worker(s)", len(missing), workers)
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    pool, git_ops.clone, spec.url_with_token, spec.local_path, spec.branch
+                )
+                for spec in missing.values()
+            )
+        )
+    for spec, ok in zip(missing.values(), results):
+        if not ok:
+            logger.error("Initial clone failed for %s into %s", spec.repo, spec.local_path)
+
+
+async def run(cfg: dict) -> None:
+    """Poll all repos from one scheduler task; each repo's watcher runs on its own thread."""
     user_name = cfg.get("git_user_name", "GitSync")
     user_email = cfg.get("git_user_email", "gitsync@local")
     pull_before_push = cfg.get("pull_before_push", True)
+    token = cfg.get("github_token")
+    webhook_cfg = cfg.get("webhook") or {}
+    webhook_enabled = bool(webhook_cfg.get("enabled", False))
+    mode = webhook_cfg.get("mode", "auto") if webhook_enabled else "polling"
+    if mode not in github_poller.POLL_MODES:
+        logger.error("Invalid webhook mode %r; expected one of %s", mode, github_poller.POLL_MODES)
+        sys.exit(1)
+    if mode != "polling" and not webhook_cfg.get("secret"):
+        logger.error(
+            "Webhook enabled but no secret set (webhook.secret or GITHUB_WEBHOOK_SECRET); "
+            "falling back to polling"
+        )
+        mode = "polling"
+    # "polling" ignores webhooks even when enabled: no receiver, no triggers
+    use_webhooks = mode != "polling"
+    triggers: dict[tuple[str, str], list[Callable[[], None]]] = {}
 
-    stop = threading.Event()
+    stop = asyncio.Event()
+    watch_stop = threading.Event()
 
-    def on_stop(signum=None, frame=None):
+    def on_stop() -> None:
         stop.set()
+        watch_stop.set()
 
-    signal.signal(signal.SIGTERM, on_stop)
-    signal.signal(signal.SIGINT, on_stop)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, on_stop)
+    loop.add_signal_handler(signal.SIGINT, on_stop)
 
     threads: list[threading.Thread] = []
-    for r in cfg["repos"]:
-        repo = r.get("repo")
-        local_path = r.get("local_path")
-        if not repo or not local_path:
-            logger.warning("Skipping repo entry missing repo or local_path: %s", r)
-            continue
-        branch = r.get("branch", "main")
-        p_interval = r.get("poll_interval_seconds", poll_interval)
-        d_seconds = r.get("debounce_seconds", debounce)
-
-        t_poll = threading.Thread(
-            target=github_poller.poll_loop,
-            args=(repo, local_path, cfg.get("github_token"), branch, p_interval, stop),
-            daemon=True,
-        )
-        t_poll.start()
-        threads.append(t_poll)
-
-        t_watch = threading.Thread(
-            target=local_watcher.watch_loop,
-            args=(
-                local_path,
-                d_seconds,
-                user_name,
-                user_email,
-                cfg.get("github_token"),
-                repo,
-                branch,
-                pull_before_push,
-                stop,
-            ),
-            daemon=True,
-        )
-        t_watch.start()
-        threads.append(t_watch)
+    async with github_poller.create_session() as session:
+        specs = build_repo_specs(cfg, token)
+        await clone_missing(specs)
+        # One lock per local_path serializes the poller's pulls with the watcher's commits
+        repo_locks: dict[str, threading.Lock] = {}
+        for spec in specs:
+            repo_locks.setdefault(spec.local_path, threading.Lock())
+
+        for spec in specs:
+            t_watch = threading.Thread(
+                target=local_watcher.watch_loop,
+                args=(
+                    spec,
+                    repo_locks[spec.local_path],
+                    user_name,
+                    user_email,
+                    pull_before_push,
+                    watch_stop,
+                ),
+                daemon=True,
+            )
+            t_watch.start()
+            threads.append(t_watch)
+
+        scheduler = PollScheduler()
+        workers = []
+        # GraphQL needs a token; one query then covers every repo per interval
+        if token and cfg.get("batch_poll", True) and len(specs) > 1:
+            queues: dict[tuple[str, str, str], list[asyncio.Queue]] = {}
+            for spec in specs:
+                if not spec.owner:
+                    logger.error("Invalid repo format: %s", spec.repo)
+                    continue
+                q: asyncio.Queue = asyncio.Queue()
+                queues.setdefault((spec.owner, spec.name, spec.branch), []).append(q)
+                if use_webhooks:
+                    key = webhook_server.repo_key(spec.normalized, spec.branch)
+                    triggers.setdefault(key, []).append(
+                        functools.partial(scheduler.wake, "batch")
+                    )
+                workers.append(github_poller.sync_worker(spec, repo_locks[spec.local_path], q, stop))
+            scheduler.add(
+                "batch",
+                github_poller.make_batch_poll_job(
+                    session, queues, token, min(s.poll_interval for s in specs), mode=mode
+                ),
+            )
+        else:
+            for spec in specs:
+                job = github_poller.make_poll_job(
+                    session, spec, repo_locks[spec.local_path], token, mode=mode
+                )
+                if job is None:
+                    continue
+                scheduler.add(spec.local_path, job)
+                if use_webhooks:
+                    key = webhook_server.repo_key(spec.normalized, spec.branch)
+                    triggers.setdefault(key, []).append(
+                        functools.partial(scheduler.wake, spec.local_path)
+                    )
+
+        runner = None
+        if use_webhooks:
+            app = webhook_server.create_app(
+                webhook_cfg["secret"],
+                triggers,
+                webhook_cfg.get("path", webhook_server.WEBHOOK_PATH),
+            )
+            runner = await webhook_server.start(
+                app, webhook_cfg.get("host", "0.0.0.0"), int(webhook_cfg.get("port", 8080))
+            )
+
+        logger.info("GitSync started with %d repo(s) (mode=%s)", len(cfg["repos"]), mode)
+        await asyncio.gather(scheduler.run(stop), *workers)
+        if runner:
+            await runner.cleanup()
 
-    logger.info("GitSync started with %d repo(s)", len(cfg["repos"]))
     for t in threads:
-        t.join()
+        await asyncio.to_thread(t.join)
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    config_path = os.environ.get("CONFIG_PATH", "/config/config.json")
+    token = os.environ.get("GITHUB_TOKEN")  # Override config if set
+    webhook_secret = os.environ.get("GITHUB_WEBHOOK_SECRET")
+    cfg = load_config(config_path)
+    if token:
+        cfg["github_token"] = token
+    if webhook_secret:
+        cfg.setdefault("webhook", {})["secret"] = webhook_secret
+    asyncio.run(run(cfg))
 
 
 if __name__ == "__main__":
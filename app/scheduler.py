@@ -0,0 +1,96 @@
+"""
+Runs periodic async jobs (one poll per repo) from a single task ordered by due time.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+# A job returns the delay in seconds until its next run, or None to wait until woken
+Job = Callable[[], Awaitable[float | None]]
+
+# Delay before re-running a job that raised
+ERROR_RETRY_SECONDS = 60.0
+
+
+class PollScheduler:
+    """Heap of (due time, job) entries served by one task that sleeps until the earliest
+    is due. Jobs run as concurrent tasks and reschedule themselves via their return value."""
+
+    def __init__(self) -> None:
+        self._jobs: dict[Hashable, Job] = {}
+        self._due: dict[Hashable, float] = {}
+        self._heap: list[tuple[float, int, Hashable]] = []
+        self._seq = itertools.count()
+        self._running: set[Hashable] = set()
+        self._rerun: set[Hashable] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._changed = asyncio.Event()
+
+    def add(self, key: Hashable, job: Job, delay: float | None = 0.0) -> None:
+        """Register job under key, first run after delay seconds (None: only when woken)."""
+        self._jobs[key] = job
+        self._set_due(key, delay)
+
+    def wake(self, key: Hashable) -> None:
+        """Run key's job now, or right after its current run finishes."""
+        if key in self._running:
+            self._rerun.add(key)
+        elif key in self._jobs:
+            self._set_due(key, 0.0)
+
+    def _set_due(self, key: Hashable, delay: float | None) -> None:
+        if delay is None:
+            self._due.pop(key, None)
+            return
+        due = time.monotonic() + delay
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+        self._changed.set()
+
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """Serve jobs until stop_event is set, then wait for running jobs to finish."""
+        stop_wait = asyncio.ensure_future(stop_event.wait())
+        try:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, key = heapq.heappop(self._heap)
+                    # Skip entries superseded by a later _set_due (e.g. a wake)
+                    if self._due.get(key) != due:
+                        continue
+                    del self._due[key]
+                    self._start(key)
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._changed.clear()
+                changed = asyncio.ensure_future(self._changed.wait())
+                await asyncio.wait(
+                    [stop_wait, changed], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                changed.cancel()
+        finally:
+            stop_wait.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start(self, key: Hashable) -> None:
+        self._running.add(key)
+        task = asyncio.ensure_future(self._run_job(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_job(self, key: Hashable) -> None:
+        try:
+            delay = await self._jobs[key]()
+        except Exception:
+            logger.exception("Scheduled job %s failed", key)
+            delay = ERROR_RETRY_SECONDS
+        finally:
+            self._running.discard(key)
+        if key in self._rerun:
+            self._rerun.discard(key)
+            delay = 0.0
+        self._set_due(key, delay)
@@ -0,0 +1,77 @@
+"""
+Receives GitHub push webhooks and wakes the matching repo's poll job.
+"""
+import hashlib
+import hmac
+import json
+import logging
+from typing import Callable
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/webhooks/github"
+
+
+def repo_key(normalized_repo: str, branch: str) -> tuple[str, str]:
+    """Key for trigger lookup: ('owner/repo' lowercased, branch)."""
+    return normalized_repo.lower(), branch
+
+
+def verify_signature(secret: str, body: bytes, signature: str | None) -> bool:
+    """Check X-Hub-Signature-256 ('sha256=<hex>') against the HMAC of body."""
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature[len("sha256="):])
+
+
+def create_app(
+    secret: str | None,
+    triggers: dict[tuple[str, str], list[Callable[[], None]]],
+    path: str = WEBHOOK_PATH,
+) -> web.Application:
+    """Build the webhook app. A push to (repo, branch) calls every callback in triggers[repo_key(...)]."""
+
+    async def handle(request: web.Request) -> web.Response:
+        body = await request.read()
+        if secret and not verify_signature(secret, body, request.headers.get("X-Hub-Signature-256")):
+            logger.warning("Rejected webhook with invalid signature from %s", request.remote)
+            return web.Response(status=401, text="invalid signature")
+        event = request.headers.get("X-GitHub-Event", "")
+        if event == "ping":
+            return web.Response(text="pong")
+        if event != "push":
+            return web.Response(status=204)
+        try:
+            payload = json.loads(body)
+            full_name = payload["repository"]["full_name"]
+            ref = payload["ref"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Malformed push webhook: %s", e)
+            return web.Response(status=400, text="malformed payload")
+        if not ref.startswith("refs/heads/"):
+            return web.Response(status=204)
+        branch = ref[len("refs/heads/"):]
+        callbacks = triggers.get(repo_key(full_name, branch))
+        if not callbacks:
+            return web.Response(status=204)
+        logger.info("Push webhook for %s@%s", full_name, branch)
+        for wake in callbacks:
+            wake()
+        return web.Response(status=202)
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+async def start(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """Start serving app on host:port. Call runner.cleanup() to stop."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("Webhook server listening on %s:%d", host, port)
+    return runner